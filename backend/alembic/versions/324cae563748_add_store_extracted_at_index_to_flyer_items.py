@@ -0,0 +1,37 @@
+"""add_store_extracted_at_index_to_flyer_items
+
+Revision ID: 324cae563748
+Revises: e977f48bccbb
+Create Date: 2026-10-15 09:12:41.204518
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '324cae563748'
+down_revision: Union[str, None] = 'e977f48bccbb'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    # Serves "latest items for a store" with an index range scan instead of filter + sort.
+    # The leading `store` column makes the old single-column index redundant.
+    op.create_index(
+        'ix_flyer_items_store_extracted',
+        'flyer_items',
+        ['store', sa.text('extracted_at DESC')],
+        unique=False
+    )
+    op.drop_index(op.f('ix_flyer_items_store'), table_name='flyer_items')
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.create_index(op.f('ix_flyer_items_store'), 'flyer_items', ['store'], unique=False)
+    op.drop_index('ix_flyer_items_store_extracted', table_name='flyer_items')
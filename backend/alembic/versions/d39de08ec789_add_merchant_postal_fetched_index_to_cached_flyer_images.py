@@ -0,0 +1,39 @@
+"""add_merchant_postal_fetched_index_to_cached_flyer_images
+
+Revision ID: d39de08ec789
+Revises: 324cae563748
+Create Date: 2026-10-15 10:03:27.558190
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'd39de08ec789'
+down_revision: Union[str, None] = '324cae563748'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    # Lets the "latest cached flyer for merchant + postal code" lookup be a single index probe
+    # instead of a bitmap-and of two single-column indexes followed by a sort.
+    op.create_index(
+        'ix_cached_merchant_postal_fetched',
+        'cached_flyer_images',
+        ['merchant_name', 'postal_code', sa.text('fetched_at DESC')],
+        unique=False
+    )
+    op.drop_index(op.f('ix_cached_flyer_images_postal_code'), table_name='cached_flyer_images')
+    op.drop_index(op.f('ix_cached_flyer_images_merchant_name'), table_name='cached_flyer_images')
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.create_index(op.f('ix_cached_flyer_images_merchant_name'), 'cached_flyer_images', ['merchant_name'], unique=False)
+    op.create_index(op.f('ix_cached_flyer_images_postal_code'), 'cached_flyer_images', ['postal_code'], unique=False)
+    op.drop_index('ix_cached_merchant_postal_fetched', table_name='cached_flyer_images')
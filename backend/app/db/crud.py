@@ -1,90 +1,176 @@
-from sqlalchemy.orm import Session
-from typing import List, Optional
-from datetime import datetime, timedelta
+from sqlalchemy import bindparam, delete, func, insert, select
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.engine import RowMapping
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import Session, aliased
+from pydantic import TypeAdapter
+from typing import List, Optional, Tuple
 
-from ..models.flyer import FlyerItem # Pydantic model for input data
 from . import models as db_models # Renamed to avoid conflict with Pydantic models
 from ..models import flyer as pydantic_flyer_models # Pydantic models for request/response
 
 # --- FlyerItem CRUD operations ---
 
-def create_flyer_items(db: Session, items: List[pydantic_flyer_models.FlyerItem]) -> List[db_models.FlyerItemDB]:
+# Pydantic fields that map 1:1 onto flyer_items columns
+_FLYER_ITEM_COLUMNS = {
+    "name", "price", "sellingUnit", "sellingValue",
+    "measuredQuantityValue", "measuredQuantityUnit", "store", "notes",
+}
+
+# Serializes a whole list of items in one call into pydantic-core instead of one model_dump() per item
+_flyer_item_list_adapter = TypeAdapter(List[pydantic_flyer_models.FlyerItem])
+
+def create_flyer_items(db: Session, items: List[pydantic_flyer_models.FlyerItem]) -> int:
     """
     Creates multiple flyer items in the database from a list of Pydantic models.
+    Rows are sent as a single executemany INSERT (batched by the engine's insertmanyvalues
+    support) rather than flushed one ORM object at a time. Returns the number of rows inserted.
     """
-    db_items = [
-        db_models.FlyerItemDB(
-            name=item.name,
-            price=item.price,
-            sellingUnit=item.sellingUnit,
-            sellingValue=item.sellingValue,
-            measuredQuantityValue=item.measuredQuantityValue,
-            measuredQuantityUnit=item.measuredQuantityUnit,
-            store=item.store,
-            notes=item.notes
-        )
-        for item in items
-    ]
-    db.add_all(db_items)
+    payload = _flyer_item_list_adapter.dump_python(items, include={"__all__": _FLYER_ITEM_COLUMNS})
+    if not payload:
+        return 0
+    db.execute(insert(db_models.FlyerItemDB), payload)
     db.commit()
-    print(f"[*] Successfully added {len(db_items)} items to the database.")
-    return db_items # Return the list of created DB objects
+    print(f"[*] Successfully added {len(payload)} items to the database.")
+    return len(payload)
+
+def _days_ago(param_name: str):
+    """SQL expression for `now() - <param_name> days`, evaluated by the database at query time."""
+    return func.now() - func.make_interval(0, 0, 0, bindparam(param_name))
+
+# Built once at import; SQLAlchemy caches the compiled SQL so each call only binds parameters
+_FLYER_ITEMS_BY_STORE_STMT = (
+    select(db_models.FlyerItemDB)
+    .where(
+        db_models.FlyerItemDB.store == bindparam("store"),
+        db_models.FlyerItemDB.extracted_at >= _days_ago("days_recent")
+    )
+    .order_by(db_models.FlyerItemDB.extracted_at.desc())
+    .limit(bindparam("limit"))
+)
+
+# Same query projected onto the plain FlyerItem columns, skipping ORM instance hydration
+_FLYER_ITEM_FIELDS_BY_STORE_STMT = _FLYER_ITEMS_BY_STORE_STMT.with_only_columns(
+    db_models.FlyerItemDB.name,
+    db_models.FlyerItemDB.price,
+    db_models.FlyerItemDB.sellingUnit,
+    db_models.FlyerItemDB.sellingValue,
+    db_models.FlyerItemDB.measuredQuantityValue,
+    db_models.FlyerItemDB.measuredQuantityUnit,
+    db_models.FlyerItemDB.store,
+    db_models.FlyerItemDB.notes,
+)
+
+# Plus extracted_at, which is not part of FlyerItem; used for /items ETags
+_FLYER_ITEM_ROWS_BY_STORE_STMT = _FLYER_ITEM_FIELDS_BY_STORE_STMT.add_columns(db_models.FlyerItemDB.extracted_at)
 
-def get_flyer_items_by_store(db: Session, store_name: str, limit: int = 100, days_recent: int = 7) -> List[db_models.FlyerItemDB]:
+async def get_flyer_items_by_store(db: AsyncSession, store_name: str, limit: int = 100, days_recent: int = 7) -> List[db_models.FlyerItemDB]:
     """
     Retrieves flyer items for a specific store, optionally filtered by how recently they were created.
     Sorts by creation date descending.
     """
-    query_date_threshold = datetime.utcnow() - timedelta(days=days_recent)
-    return (db.query(db_models.FlyerItemDB)
-              .filter(db_models.FlyerItemDB.store == store_name)
-              .filter(db_models.FlyerItemDB.extracted_at >= query_date_threshold)
-              .order_by(db_models.FlyerItemDB.extracted_at.desc())
-              .limit(limit)
-              .all())
+    result = await db.execute(
+        _FLYER_ITEMS_BY_STORE_STMT,
+        {"store": store_name, "days_recent": days_recent, "limit": limit}
+    )
+    return result.scalars().all()
+
+async def get_flyer_item_rows_by_store(db: AsyncSession, store_name: str, limit: int = 100, days_recent: int = 7) -> List[RowMapping]:
+    """
+    Same as get_flyer_items_by_store, but returns lightweight column mappings instead of ORM objects.
+    Use for read paths that only serialize the items.
+    """
+    result = await db.execute(
+        _FLYER_ITEM_ROWS_BY_STORE_STMT,
+        {"store": store_name, "days_recent": days_recent, "limit": limit}
+    )
+    return result.mappings().all()
+
+async def get_flyer_item_dicts_by_store(db: AsyncSession, store_name: str, limit: int = 100, days_recent: int = 7) -> List[dict]:
+    """
+    Same as get_flyer_items_by_store, but returns plain dicts of the FlyerItem fields,
+    ready to hand to services that take item dicts (e.g. meal plan generation).
+    """
+    result = await db.execute(
+        _FLYER_ITEM_FIELDS_BY_STORE_STMT,
+        {"store": store_name, "days_recent": days_recent, "limit": limit}
+    )
+    return [dict(row) for row in result.mappings()]
 
 # --- CachedFlyerImage CRUD operations ---
 
-def create_cached_flyer_image(db: Session, flipp_flyer_id: int, merchant_name: str, image_path: str, postal_code: str) -> db_models.CachedFlyerImage:
-    """Creates a new cached flyer image record in the database."""
-    db_cached_flyer = db_models.CachedFlyerImage(
-        flipp_flyer_id=flipp_flyer_id,
-        merchant_name=merchant_name,
-        image_path=image_path,
-        postal_code=postal_code
-        # fetched_at is handled by server_default
+def upsert_cached_flyer_image(db: Session, flipp_flyer_id: int, merchant_name: str, image_path: str, postal_code: str) -> Tuple[db_models.CachedFlyerImage, Optional[str]]:
+    """
+    Inserts or replaces the cached flyer image record for a Flipp flyer ID in one statement
+    (PostgreSQL INSERT ... ON CONFLICT DO UPDATE ... RETURNING), resetting fetched_at on replace.
+    Returns the stored record and the image_path of the record it replaced (None on a fresh insert).
+    """
+    # RETURNING subqueries read the pre-statement snapshot, so this yields the replaced row's path
+    previous = aliased(db_models.CachedFlyerImage)
+    old_image_path = (
+        select(previous.image_path)
+        .where(previous.flipp_flyer_id == flipp_flyer_id)
+        .scalar_subquery()
+    )
+    stmt = (
+        pg_insert(db_models.CachedFlyerImage)
+        .values(
+            flipp_flyer_id=flipp_flyer_id,
+            merchant_name=merchant_name,
+            image_path=image_path,
+            postal_code=postal_code
+        )
+        .on_conflict_do_update(
+            index_elements=[db_models.CachedFlyerImage.flipp_flyer_id],
+            set_={
+                "merchant_name": merchant_name,
+                "image_path": image_path,
+                "postal_code": postal_code,
+                "fetched_at": func.now()
+            }
+        )
+        .returning(db_models.CachedFlyerImage, old_image_path.label("old_image_path"))
+        .execution_options(populate_existing=True) # Overwrite any stale instance already in the session
     )
-    db.add(db_cached_flyer)
+    db_cached_flyer, replaced_image_path = db.execute(stmt).one()
     db.commit()
-    db.refresh(db_cached_flyer)
-    return db_cached_flyer
+    return db_cached_flyer, replaced_image_path
+
+_CACHED_FLYER_BY_FLIPP_ID_STMT = (
+    select(db_models.CachedFlyerImage)
+    .where(db_models.CachedFlyerImage.flipp_flyer_id == bindparam("flipp_flyer_id"))
+)
+
+_CACHED_FLYER_BY_MERCHANT_AND_POSTAL_STMT = (
+    select(db_models.CachedFlyerImage)
+    .where(
+        db_models.CachedFlyerImage.merchant_name == bindparam("merchant_name"),
+        db_models.CachedFlyerImage.postal_code == bindparam("postal_code"),
+        db_models.CachedFlyerImage.fetched_at >= _days_ago("days_valid")
+    )
+    .order_by(db_models.CachedFlyerImage.fetched_at.desc())
+    .limit(1)
+)
 
 def get_cached_flyer_image_by_flipp_id(db: Session, flipp_flyer_id: int) -> Optional[db_models.CachedFlyerImage]:
     """Retrieves a cached flyer image by its Flipp flyer ID."""
-    return db.query(db_models.CachedFlyerImage).filter(db_models.CachedFlyerImage.flipp_flyer_id == flipp_flyer_id).first()
+    return db.execute(_CACHED_FLYER_BY_FLIPP_ID_STMT, {"flipp_flyer_id": flipp_flyer_id}).scalars().first()
 
 def get_cached_flyer_image_by_merchant_and_postal(db: Session, merchant_name: str, postal_code: str, days_valid: int = 7) -> Optional[db_models.CachedFlyerImage]:
     """
     Retrieves the most recent valid cached flyer image for a given merchant and postal code.
     A flyer is considered valid if fetched within the last `days_valid` days.
     """
-    cutoff_date = datetime.utcnow() - timedelta(days=days_valid)
-    return (
-        db.query(db_models.CachedFlyerImage)
-        .filter(
-            db_models.CachedFlyerImage.merchant_name == merchant_name,
-            db_models.CachedFlyerImage.postal_code == postal_code,
-            db_models.CachedFlyerImage.fetched_at >= cutoff_date
-        )
-        .order_by(db_models.CachedFlyerImage.fetched_at.desc())
-        .first()
-    )
+    return db.execute(
+        _CACHED_FLYER_BY_MERCHANT_AND_POSTAL_STMT,
+        {"merchant_name": merchant_name, "postal_code": postal_code, "days_valid": days_valid}
+    ).scalars().first()
 
 def delete_cached_flyer_image(db: Session, flipp_flyer_id: int) -> bool:
     """Deletes a cached flyer image by its Flipp flyer ID. Returns True if deleted, False otherwise."""
-    db_cached_flyer = get_cached_flyer_image_by_flipp_id(db, flipp_flyer_id)
-    if db_cached_flyer:
-        db.delete(db_cached_flyer)
-        db.commit()
-        return True
-    return False
+    result = db.execute(
+        delete(db_models.CachedFlyerImage)
+        .where(db_models.CachedFlyerImage.flipp_flyer_id == flipp_flyer_id)
+    )
+    db.commit()
+    return result.rowcount > 0
@@ -1,4 +1,5 @@
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, make_url
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
 import os
@@ -16,9 +17,38 @@ if not DATABASE_URL:
     raise ValueError("DATABASE_URL environment variable not set.")
 else:
     # For PostgreSQL
-    engine = create_engine(DATABASE_URL)
+    # Each worker process can open up to (pool_size + max_overflow) connections per engine, so keep
+    # PostgreSQL's max_connections >= (10 sync + 20 async) * number of uvicorn workers, plus headroom
+    # for Alembic and psql. That is 30 per worker; the stock max_connections=100 covers 3 workers.
+    engine = create_engine(
+        DATABASE_URL,
+        # Serves the async flyer endpoints' calls via asyncio.to_thread (cached-flyer lookup and upsert,
+        # /extract item inserts) and the sync GET /flyer/image handler; /flyer/items reads use async_engine
+        pool_size=5,
+        max_overflow=5,
+        pool_pre_ping=True, # Transparently replace connections dropped by the server
+        pool_recycle=1800, # Seconds
+        pool_use_lifo=True, # Reuse warm connections first so idle ones can be recycled
+        # Batch executemany INSERTs into multi-row VALUES statements (used by crud.create_flyer_items)
+        executemany_mode="values_plus_batch",
+        insertmanyvalues_page_size=1000,
+        query_cache_size=1200, # Compiled-statement cache entries (default 500)
+    )
+    # Async engine (asyncpg driver) for the read endpoints, which query without a threadpool hop.
+    # Writes, the cached-flyer reads and Alembic still use the sync engine above while they are migrated.
+    async_engine = create_async_engine(
+        make_url(DATABASE_URL).set(drivername="postgresql+asyncpg"),
+        pool_size=10,
+        max_overflow=10,
+        pool_pre_ping=True,
+        pool_recycle=1800,
+        pool_use_lifo=True,
+        query_cache_size=1200,
+    )
 
-SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+# expire_on_commit=False keeps values loaded via RETURNING usable after commit without a refresh SELECT
+SessionLocal = sessionmaker(autocommit=False, autoflush=False, expire_on_commit=False, bind=engine)
+AsyncSessionLocal = async_sessionmaker(async_engine, autoflush=False, expire_on_commit=False)
 
 Base = declarative_base()
 
@@ -29,3 +59,8 @@ def get_db():
         yield db
     finally:
         db.close()
+
+# Dependency to get an AsyncSession in async FastAPI endpoints
+async def get_async_db():
+    async with AsyncSessionLocal() as db:
+        yield db
@@ -1,4 +1,4 @@
-from sqlalchemy import Column, Integer, String, Float, DateTime, ForeignKey, func
+from sqlalchemy import Column, Integer, String, Float, DateTime, ForeignKey, Index, func
 from sqlalchemy.orm import relationship
 from .database import Base
 
@@ -12,17 +12,27 @@ class FlyerItemDB(Base):
     sellingValue = Column(Float, nullable=True)
     measuredQuantityValue = Column(Float, nullable=True) # Made nullable=True as per Pydantic model
     measuredQuantityUnit = Column(String, nullable=True) # Made nullable=True as per Pydantic model
-    store = Column(String, index=True, nullable=False)
+    store = Column(String, nullable=False) # Indexed via ix_flyer_items_store_extracted below
     notes = Column(String, nullable=True)
     extracted_at = Column(DateTime(timezone=True), server_default=func.now())
     created_at = Column(DateTime(timezone=True), server_default=func.now())
 
+    __table_args__ = (
+        # Matches crud.get_flyer_items_by_store: filter on store, newest extracted_at first
+        Index("ix_flyer_items_store_extracted", store, extracted_at.desc()),
+    )
+
 class CachedFlyerImage(Base):
     __tablename__ = "cached_flyer_images"
 
     id = Column(Integer, primary_key=True, index=True)
     flipp_flyer_id = Column(Integer, unique=True, index=True, nullable=False)
-    merchant_name = Column(String, index=True, nullable=False)
+    merchant_name = Column(String, nullable=False) # Indexed via ix_cached_merchant_postal_fetched below
     image_path = Column(String, nullable=False, unique=True) # Path to the locally stored stitched image
-    postal_code = Column(String, index=True, nullable=False)
+    postal_code = Column(String, nullable=False) # Indexed via ix_cached_merchant_postal_fetched below
     fetched_at = Column(DateTime(timezone=True), server_default=func.now())
+
+    __table_args__ = (
+        # Matches crud.get_cached_flyer_image_by_merchant_and_postal: equality on merchant + postal, newest first
+        Index("ix_cached_merchant_postal_fetched", merchant_name, postal_code, fetched_at.desc()),
+    )
@@ -1,4 +1,16 @@
+"""
+WhatTheFlip API entry point.
+
+For production, run with the uvloop event loop and httptools HTTP parser (both installed by
+uvicorn[standard]) and one worker per core:
+
+    uvicorn app.main:app --host 0.0.0.0 --port 8000 --loop uvloop --http httptools --workers $(nproc)
+
+Each worker can hold up to 30 database connections (see app/db/database.py), so raise
+PostgreSQL's max_connections to at least 30 * workers, or cap --workers to fit.
+"""
 from fastapi import FastAPI
+from fastapi.middleware.gzip import GZipMiddleware
 from .routers import flyer, mealplan # Import the flyer and mealplan routers
 
 app = FastAPI(
@@ -7,6 +19,9 @@ app = FastAPI(
     version="0.1.0",
 )
 
+# Compress larger JSON payloads (e.g. /flyer/items lists); tiny responses aren't worth the CPU
+app.add_middleware(GZipMiddleware, minimum_size=1024, compresslevel=5)
+
 # Include the routers
 app.include_router(flyer.router)
 app.include_router(mealplan.router) # Add the meal plan router
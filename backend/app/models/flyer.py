@@ -1,7 +1,9 @@
-from pydantic import BaseModel, Field
+from pydantic import BaseModel, ConfigDict, Field
 from typing import List, Optional, Literal
 
 class FlyerItem(BaseModel):
+    model_config = ConfigDict(from_attributes=True)
+
     name: str = Field(..., description="The name of the produce item as advertised (e.g., 'Tomatoes on the Vine', 'Russet Potatoes').")
     price: float = Field(..., description="The total selling price advertised for the item based on its selling unit (e.g., price for 1 pack, price per lb).")
     sellingUnit: Literal["pack", "bag", "lb", "kg", "each", "oz", "g", "count", "bunch", "bottle", "tin", "canister"] = Field(..., description="The primary unit by which the item is sold or priced.")
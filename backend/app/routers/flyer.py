@@ -1,4 +1,6 @@
-from fastapi import APIRouter, UploadFile, File, HTTPException, Form, Depends, Request
+from fastapi import APIRouter, UploadFile, File, HTTPException, Form, Depends, Request, Response
+from fastapi.responses import FileResponse
+from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.orm import Session
 from pydantic import BaseModel, ValidationError
 from typing import List, Optional
@@ -7,10 +9,12 @@ import logging
 from ..services import gemini_service, flyer_acquisition_service
 from ..models.flyer import FlyerItemList, FlyerItem
 from ..db import crud
-from ..db.database import get_db
-import shutil
+from ..db.database import get_async_db, get_db
+import asyncio
+import mimetypes
 import os
-import uuid
+import time
+from cachetools import TLRUCache, TTLCache
 
 router = APIRouter(
     prefix="/flyer",
@@ -19,19 +23,86 @@ router = APIRouter(
 
 logger = logging.getLogger(__name__)
 
-# Define a temporary directory for uploads
+# Define the base directory for files stored by the backend
 UPLOAD_DIR = "temp_uploads"
 STITCHED_FLYERS_SUBDIR = "stitched_flyers"
 
+# The module-level caches and sets below are only read and written by async handlers on the event
+# loop (never from to_thread workers), so they need no lock.
+
+# In-process cache of /items responses: store_name -> (etag, rows).
+# Entries are dropped when /extract saves new items for that store.
+ITEMS_CACHE_TTL_S = 300
+_items_cache: TTLCache = TTLCache(maxsize=256, ttl=ITEMS_CACHE_TTL_S)
+
+# (merchant, postal) -> (flipp_flyer_id, image_path, merchant_name, postal_code, valid_until) of the cached
+# flyer, so repeat /fetch-and-store requests skip the DB lookup.
+# An entry lives for FLYER_LOOKUP_CACHE_TTL_S at most, and never past the end of its row's validity.
+FLYER_LOOKUP_CACHE_TTL_S = 3600
+FLYER_VALID_DAYS = 7 # A cached flyer image is reused for this long after it was fetched
+_flyer_lookup_cache: TLRUCache = TLRUCache(
+    maxsize=1024,
+    ttu=lambda _key, entry, now: min(now + FLYER_LOOKUP_CACHE_TTL_S, entry[4]),
+    timer=time.time,
+)
+
+# Stored flyer images only change when re-fetched, which also changes their ETag
+FLYER_IMAGE_MAX_AGE_S = 86400
+
+# Caps concurrent Gemini extractions per worker to protect the API quota
+GEMINI_SEM = asyncio.Semaphore(int(os.getenv("GEMINI_CONCURRENCY", "4")))
+
+# Directories already created by this process, so request handlers skip the makedirs syscalls.
+_dirs_ready: set[str] = set()
+
+def _ensure_dir(path: str) -> None:
+    if path in _dirs_ready:
+        return
+    os.makedirs(path, exist_ok=True)
+    _dirs_ready.add(path)
+
 @router.on_event("startup")
 def startup_event():
-    # Create the temporary upload directory if it doesn't exist
-    os.makedirs(UPLOAD_DIR, exist_ok=True)
+    # Create the base storage directory if it doesn't exist
+    _ensure_dir(UPLOAD_DIR)
     # Create the subdirectory for stitched flyers
     stitched_flyer_path = os.path.join(UPLOAD_DIR, STITCHED_FLYERS_SUBDIR)
-    os.makedirs(stitched_flyer_path, exist_ok=True)
+    _ensure_dir(stitched_flyer_path)
     logger.info(f"Upload directory '{UPLOAD_DIR}' and '{stitched_flyer_path}' ensured.")
 
+@router.on_event("shutdown")
+async def shutdown_event():
+    await flyer_acquisition_service.close_http_sessions()
+
+def _flyer_lookup_key(merchant_name: str, postal_code: str) -> tuple[str, str]:
+    return merchant_name.strip().lower(), postal_code.upper().replace(" ", "")
+
+def _flyer_lookup_entry(cached_flyer) -> tuple:
+    valid_until = cached_flyer.fetched_at.timestamp() + FLYER_VALID_DAYS * 86400
+    return (cached_flyer.flipp_flyer_id, cached_flyer.image_path, cached_flyer.merchant_name, cached_flyer.postal_code, valid_until)
+
+async def _cached_flyer_lookup(db: Session, merchant_name: str, postal_code: str):
+    """
+    Returns (flipp_flyer_id, image_path, merchant_name, postal_code, valid_until) of a valid cached flyer, or None.
+    Checks the in-process cache before querying the database in a worker thread.
+    """
+    key = _flyer_lookup_key(merchant_name, postal_code)
+    entry = _flyer_lookup_cache.get(key)
+    if entry:
+        return entry
+    cached_flyer = await asyncio.to_thread(crud.get_cached_flyer_image_by_merchant_and_postal, db, merchant_name, postal_code, FLYER_VALID_DAYS)
+    if not cached_flyer:
+        return None
+    entry = _flyer_lookup_entry(cached_flyer)
+    _flyer_lookup_cache[key] = entry
+    return entry
+
+def _invalidate_flyer_lookup(flipp_flyer_id: int) -> None:
+    """Drops every in-process lookup entry pointing at the given Flipp flyer."""
+    for key, entry in list(_flyer_lookup_cache.items()):
+        if entry[0] == flipp_flyer_id:
+            _flyer_lookup_cache.pop(key, None)
+
 # --- Pydantic Models for Fetch & Store Endpoint ---
 class FetchFlyerRequest(BaseModel):
     merchant_name: str
@@ -54,80 +125,95 @@ async def fetch_and_store_flyer(
     logger.info(f"Received request to fetch/store flyer for merchant: {request_data.merchant_name}, postal: {request_data.postal_code}")
 
     # 1. Check cache by merchant and postal code (for recent flyers)
-    cached_flyer = crud.get_cached_flyer_image_by_merchant_and_postal(
-        db, request_data.merchant_name, request_data.postal_code
-    )
+    cached_flyer = await _cached_flyer_lookup(db, request_data.merchant_name, request_data.postal_code)
     if cached_flyer:
-        logger.info(f"Valid cached flyer found: ID {cached_flyer.flipp_flyer_id}, Path: {cached_flyer.image_path}")
+        cached_flyer_id, cached_image_path, cached_merchant_name, cached_postal_code, _ = cached_flyer
+        logger.info(f"Valid cached flyer found: ID {cached_flyer_id}, Path: {cached_image_path}")
         return FetchedFlyerInfoResponse(
-            flipp_flyer_id=cached_flyer.flipp_flyer_id,
-            merchant_name=cached_flyer.merchant_name,
-            image_path=cached_flyer.image_path,
-            postal_code=cached_flyer.postal_code,
+            flipp_flyer_id=cached_flyer_id,
+            merchant_name=cached_merchant_name,
+            image_path=cached_image_path,
+            postal_code=cached_postal_code,
             message="Using valid cached flyer image."
         )
 
     logger.info(f"No valid cached flyer for {request_data.merchant_name} at {request_data.postal_code}. Fetching from source.")
     # 2. If not in cache or outdated, fetch from service
-    new_flipp_flyer_id_str, image_bytes = await flyer_acquisition_service.get_flyer_image_data_and_id(
+    stitched_flyer_dir = os.path.join(UPLOAD_DIR, STITCHED_FLYERS_SUBDIR)
+    # Ensure directory exists (created at startup; only checked again if that didn't run)
+    _ensure_dir(stitched_flyer_dir)
+    # The service encodes into a temp file next to the final location, so saving it is a rename
+    new_flipp_flyer_id_str, tmp_image_path = await flyer_acquisition_service.get_flyer_image_file_and_id(
         postal_code=request_data.postal_code,
         merchant_name=request_data.merchant_name,
-        category=request_data.category
+        category=request_data.category,
+        output_dir=stitched_flyer_dir
     )
 
-    if not new_flipp_flyer_id_str or not image_bytes:
+    if not new_flipp_flyer_id_str or not tmp_image_path:
         logger.error(f"Failed to fetch flyer data for {request_data.merchant_name} at {request_data.postal_code} from acquisition service.")
         raise HTTPException(status_code=404, detail=f"Flyer for '{request_data.merchant_name}' not found or could not be processed at postal code '{request_data.postal_code}'.")
     
     new_flipp_flyer_id = int(new_flipp_flyer_id_str)
 
-    # 3. Check if this flipp_flyer_id already exists (could be outdated or from different postal code search)
-    # If so, remove old file and DB record before saving new one.
-    existing_record_for_id = crud.get_cached_flyer_image_by_flipp_id(db, new_flipp_flyer_id)
-    if existing_record_for_id:
-        logger.info(f"Found existing record for flipp_flyer_id {new_flipp_flyer_id} (path: {existing_record_for_id.image_path}). Replacing it.")
-        if os.path.exists(existing_record_for_id.image_path):
-            try:
-                os.remove(existing_record_for_id.image_path)
-                logger.info(f"Deleted old image file: {existing_record_for_id.image_path}")
-            except OSError as e:
-                logger.warning(f"Could not delete old image file {existing_record_for_id.image_path}: {e}")
-        crud.delete_cached_flyer_image(db, new_flipp_flyer_id) # This function handles commit
-        logger.info(f"Deleted old DB record for flipp_flyer_id {new_flipp_flyer_id}")
-
-    # 4. Save the new image
-    stitched_flyer_dir = os.path.join(UPLOAD_DIR, STITCHED_FLYERS_SUBDIR)
-    # Ensure directory exists (should be by startup, but good to be safe)
-    os.makedirs(stitched_flyer_dir, exist_ok=True) 
-    image_filename = f"{new_flipp_flyer_id}.png" # Use flipp_flyer_id for unique, predictable filename
+    # 3. Final location of the new image
+    image_filename = f"{new_flipp_flyer_id}.jpg" # Use flipp_flyer_id for unique, predictable filename
     saved_image_path = os.path.join(stitched_flyer_dir, image_filename)
 
-    try:
-        with open(saved_image_path, "wb") as f:
-            f.write(image_bytes)
-        logger.info(f"Saved new stitched flyer to {saved_image_path}")
-    except IOError as e:
-        logger.error(f"Failed to save stitched flyer image to {saved_image_path}: {e}")
-        raise HTTPException(status_code=500, detail="Failed to save processed flyer image.")
+    lookup_key = _flyer_lookup_key(request_data.merchant_name, request_data.postal_code)
 
-    # 5. Create new cache record in DB
+    # 4. Insert the cache record, or replace the existing one for this flipp_flyer_id (could be outdated
+    # or from a different postal code search), in a single statement. This commits before the image is
+    # moved into place, so a failed write never leaves an existing row pointing at a deleted file.
     try:
-        db_cached_flyer = crud.create_cached_flyer_image(
+        # The sync session runs in a worker thread so the psycopg2 round trip doesn't block the event loop
+        db_cached_flyer, replaced_image_path = await asyncio.to_thread(
+            crud.upsert_cached_flyer_image,
             db=db,
             flipp_flyer_id=new_flipp_flyer_id,
             merchant_name=request_data.merchant_name, # Use merchant name from request
             image_path=saved_image_path, # Store the absolute path
             postal_code=request_data.postal_code
         )
-        logger.info(f"Successfully cached new flyer image: ID {db_cached_flyer.flipp_flyer_id}, Path: {db_cached_flyer.image_path}")
-    except Exception as e: # Catch potential DB errors, e.g., unique constraints if logic above missed something
+    except Exception as e: # Catch potential DB errors
         logger.error(f"Failed to create cache record for flyer ID {new_flipp_flyer_id}: {e}")
-        # Attempt to clean up saved image if DB entry fails
-        if os.path.exists(saved_image_path):
-            try: os.remove(saved_image_path) 
-            except OSError: pass
+        # Only the temp file is ours to clean up; saved_image_path may still back an existing row
+        try: os.remove(tmp_image_path)
+        except OSError: pass
+        _invalidate_flyer_lookup(new_flipp_flyer_id)
+        _flyer_lookup_cache.pop(lookup_key, None)
         raise HTTPException(status_code=500, detail="Failed to save flyer information to database.")
 
+    # 5. Move the new image into place
+    try:
+        os.replace(tmp_image_path, saved_image_path) # Atomic rename; no copy of the image data
+        logger.info(f"Saved new stitched flyer to {saved_image_path}")
+    except OSError as e:
+        logger.error(f"Failed to save stitched flyer image to {saved_image_path}: {e}")
+        try: os.remove(tmp_image_path)
+        except OSError: pass
+        _invalidate_flyer_lookup(new_flipp_flyer_id)
+        _flyer_lookup_cache.pop(lookup_key, None)
+        # Don't leave the new row pointing at a file that was never written
+        if not os.path.exists(saved_image_path):
+            try: await asyncio.to_thread(crud.delete_cached_flyer_image, db=db, flipp_flyer_id=new_flipp_flyer_id)
+            except Exception as db_e: logger.warning(f"Could not remove cache record for flyer ID {new_flipp_flyer_id}: {db_e}")
+        raise HTTPException(status_code=500, detail="Failed to save processed flyer image.")
+
+    logger.info(f"Successfully cached new flyer image: ID {db_cached_flyer.flipp_flyer_id}, Path: {db_cached_flyer.image_path}")
+    _invalidate_flyer_lookup(new_flipp_flyer_id)
+    _flyer_lookup_cache[lookup_key] = _flyer_lookup_entry(db_cached_flyer)
+
+    # Remove the replaced record's image unless the new file overwrote it in place
+    if replaced_image_path and replaced_image_path != saved_image_path:
+        try:
+            os.remove(replaced_image_path)
+            logger.info(f"Deleted old image file: {replaced_image_path}")
+        except FileNotFoundError:
+            pass
+        except OSError as e:
+            logger.warning(f"Could not delete old image file {replaced_image_path}: {e}")
+
     return FetchedFlyerInfoResponse(
         flipp_flyer_id=db_cached_flyer.flipp_flyer_id,
         merchant_name=db_cached_flyer.merchant_name,
@@ -148,48 +234,38 @@ async def extract_flyer_endpoint(
     extracts item data using Gemini, validates the data, saves it to the database,
     and returns a status message.
     """
-    input_image_path: str = ""
-    delete_input_image_after_processing: bool = False
-
     if image_path:
         logger.info(f"Extracting from provided image_path: {image_path} for store: {store_name}")
         if not os.path.exists(image_path):
             logger.error(f"Provided image_path does not exist: {image_path}")
             raise HTTPException(status_code=400, detail=f"Provided image_path does not exist: {image_path}")
-        input_image_path = image_path
-        delete_input_image_after_processing = False # Do not delete if path was provided
+        source_description = image_path
     elif file:
         logger.info(f"Extracting from uploaded file: {file.filename} for store: {store_name}")
-        # Generate a unique filename to avoid collisions for uploaded file
-        file_extension = os.path.splitext(file.filename)[1] if file.filename else ".png"
-        temp_filename = f"{uuid.uuid4()}{file_extension}"
-        temp_upload_path = os.path.join(UPLOAD_DIR, temp_filename)
-        
+        # Keep the upload in memory and hand the bytes straight to Gemini; no temp file round trip
         try:
-            with open(temp_upload_path, "wb") as buffer:
-                shutil.copyfileobj(file.file, buffer)
-            logger.info(f"Uploaded file saved temporarily to: {temp_upload_path}")
-            input_image_path = temp_upload_path
-            delete_input_image_after_processing = True # Uploaded temp file should be deleted
+            file_bytes = await file.read()
         except Exception as e:
-            logger.error(f"Could not save uploaded file: {e}")
-            raise HTTPException(status_code=500, detail=f"Could not save uploaded file: {e}")
+            logger.error(f"Could not read uploaded file: {e}")
+            raise HTTPException(status_code=500, detail=f"Could not read uploaded file: {e}")
         finally:
-            if file.file and not file.file.closed:
-                 await file.close() # Ensure uploaded file stream is closed
+            await file.close() # Ensure uploaded file stream is closed
+        mime_type = file.content_type
+        if not mime_type or mime_type == "application/octet-stream":
+            mime_type, _ = mimetypes.guess_type(file.filename or "")
+        source_description = f"upload '{file.filename}' ({mime_type})"
     else:
         logger.error("No image_path or file provided for extraction.")
         raise HTTPException(status_code=400, detail="You must provide either an image_path or upload a file.")
 
-    if not input_image_path:
-        # This case should ideally be caught by the logic above, but as a safeguard:
-        logger.error("Input image path was not set prior to extraction attempt.")
-        raise HTTPException(status_code=500, detail="Internal error: Image path not determined.")
-
     try:
-        # Call the Gemini service with the determined input_image_path
-        logger.info(f"Calling Gemini service for image: {input_image_path}")
-        extracted_data = gemini_service.extract_flyer_data_from_image(input_image_path, store_name)
+        # Call the Gemini service in a worker thread so the event loop keeps serving other requests
+        logger.info(f"Calling Gemini service for {source_description}")
+        async with GEMINI_SEM:
+            if image_path:
+                extracted_data = await asyncio.to_thread(gemini_service.extract_flyer_data_from_image, image_path, store_name)
+            else:
+                extracted_data = await asyncio.to_thread(gemini_service.extract_flyer_data_from_bytes, file_bytes, mime_type or "", store_name)
 
         if "error" in extracted_data:
             logger.error(f"Gemini service error: {extracted_data['error']}")
@@ -207,39 +283,77 @@ async def extract_flyer_endpoint(
             raise HTTPException(status_code=400, detail=f"Extracted data validation failed: {e}")
 
         try:
-            created_db_items = crud.create_flyer_items(db=db, items=validated_data.items)
-            logger.info(f"Successfully extracted and saved {len(created_db_items)} items for store {store_name}.")
-            return {"message": f"Successfully extracted and saved {len(created_db_items)} items."}
+            created_count = await asyncio.to_thread(crud.create_flyer_items, db=db, items=validated_data.items)
+            _invalidate_items_cache({item.store for item in validated_data.items})
+            logger.info(f"Successfully extracted and saved {created_count} items for store {store_name}.")
+            return {"message": f"Successfully extracted and saved {created_count} items."}
         except Exception as db_exc:
             logger.error(f"Database error while saving items for {store_name}: {db_exc}")
-            db.rollback()
+            await asyncio.to_thread(db.rollback)
             raise HTTPException(status_code=500, detail=f"Database error occurred: {db_exc}")
 
     except HTTPException as http_exc:
         # Re-raise HTTPExceptions directly
         raise http_exc
     except Exception as e:
-        logger.exception(f"Unexpected error in /extract endpoint for image {input_image_path}")
+        logger.exception(f"Unexpected error in /extract endpoint for {source_description}")
         raise HTTPException(status_code=500, detail=f"Internal server error: {e}")
-    finally:
-        if delete_input_image_after_processing and os.path.exists(input_image_path):
-            try:
-                os.remove(input_image_path)
-                logger.info(f"Deleted temporary uploaded file: {input_image_path}")
-            except Exception as remove_err:
-                logger.error(f"Error removing temp file {input_image_path}: {remove_err}")
-
-@router.get("/items/{store_name}", response_model=List[FlyerItem], responses={404: {"description": "No items found for this store"}})
-def read_flyer_items(store_name: str, db: Session = Depends(get_db)):
+
+def _items_etag(db_items) -> str:
+    """Builds an ETag from the row count and newest extracted_at (rows are sorted newest first)."""
+    if not db_items:
+        return '"0"'
+    return f'"{len(db_items)}-{db_items[0]["extracted_at"].timestamp()}"'
+
+def _invalidate_items_cache(store_names) -> None:
+    for name in store_names:
+        _items_cache.pop(name, None)
+
+@router.get("/items/{store_name}", response_model=List[FlyerItem], responses={304: {"description": "Items unchanged since the ETag in If-None-Match"}, 404: {"description": "No items found for this store"}})
+async def read_flyer_items(store_name: str, request: Request, response: Response, db: AsyncSession = Depends(get_async_db)):
     """
     Retrieves flyer items for a specific store from the database.
+    Responses are cached in-process and carry an ETag, so repeat requests can be answered with 304.
     """
     print(f"[*] Received request to get items for store: {store_name}")
-    # Use the existing CRUD function to get items
-    db_items = crud.get_flyer_items_by_store(db=db, store_name=store_name)
+    cached = _items_cache.get(store_name)
+    if cached:
+        etag, db_items = cached
+    else:
+        # Fetch plain column rows; no ORM objects are needed just to serialize the response
+        db_items = await crud.get_flyer_item_rows_by_store(db=db, store_name=store_name)
+        etag = _items_etag(db_items)
+        _items_cache[store_name] = (etag, db_items)
+
+    cache_headers = {"ETag": etag, "Cache-Control": f"public, max-age={ITEMS_CACHE_TTL_S}"}
+    if request.headers.get("if-none-match") == etag:
+        return Response(status_code=304, headers=cache_headers)
+    response.headers.update(cache_headers)
+
     if not db_items:
         print(f"[!] No items found for store: {store_name}")
         # Returning an empty list is fine as the frontend handles it
     print(f"[*] Found {len(db_items) if db_items else 0} items for store: {store_name}")
-    # FastAPI automatically converts SQLAlchemy models to Pydantic response_model if fields match
-    return db_items
\ No newline at end of file
+    # FastAPI validates the row mappings against the FlyerItem response_model
+    return db_items
+
+@router.get("/image/{flipp_flyer_id}", response_class=FileResponse, responses={304: {"description": "Image unchanged since the ETag in If-None-Match"}, 404: {"description": "No cached image for this flyer"}})
+def get_flyer_image(flipp_flyer_id: int, request: Request, db: Session = Depends(get_db)):
+    """
+    Serves the stored stitched image for a cached flyer.
+    The ETag comes from the DB record (a replaced image gets a new fetched_at), so 304s need no file stat.
+    """
+    cached_flyer = crud.get_cached_flyer_image_by_flipp_id(db, flipp_flyer_id)
+    if not cached_flyer:
+        raise HTTPException(status_code=404, detail=f"No cached image for flyer ID {flipp_flyer_id}.")
+
+    etag = f'"{cached_flyer.flipp_flyer_id}-{cached_flyer.fetched_at.timestamp()}"'
+    cache_headers = {"ETag": etag, "Cache-Control": f"public, max-age={FLYER_IMAGE_MAX_AGE_S}"}
+    if request.headers.get("if-none-match") == etag:
+        return Response(status_code=304, headers=cache_headers)
+
+    if not os.path.isfile(cached_flyer.image_path):
+        logger.error(f"Cached image file missing for flyer ID {flipp_flyer_id}: {cached_flyer.image_path}")
+        raise HTTPException(status_code=404, detail=f"Image file for flyer ID {flipp_flyer_id} is missing.")
+    media_type, _ = mimetypes.guess_type(cached_flyer.image_path)
+    return FileResponse(cached_flyer.image_path, media_type=media_type or "image/jpeg", headers=cache_headers)
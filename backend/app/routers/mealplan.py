@@ -1,9 +1,9 @@
 from fastapi import APIRouter, Depends, HTTPException
-from sqlalchemy.orm import Session
+from sqlalchemy.ext.asyncio import AsyncSession
 from typing import List
 
 from app.db import crud, models as db_models # Renamed to avoid conflict
-from app.db.database import get_db
+from app.db.database import get_async_db
 from app.models.mealplan import MealPlanRequest, MealPlanResponse
 from app.services import gemini_service
 
@@ -15,7 +15,7 @@ router = APIRouter(
 @router.post("/generate/", response_model=MealPlanResponse)
 async def generate_meal_plan(
     request: MealPlanRequest,
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_async_db)
 ):
     """
     Generates a 5-day meal plan based on recently extracted flyer items for a given store.
@@ -24,28 +24,14 @@ async def generate_meal_plan(
 
     # 1. Fetch recent flyer items from DB
     # Using default limit of 100 items from last 7 days
-    db_items = crud.get_flyer_items_by_store(db=db, store_name=request.store_name)
-    if not db_items:
+    items_for_gemini = await crud.get_flyer_item_dicts_by_store(db=db, store_name=request.store_name)
+    if not items_for_gemini:
         raise HTTPException(status_code=404, detail=f"No recent flyer items found for store '{request.store_name}'. Extract flyer data first.")
 
-    print(f"[*] Found {len(db_items)} relevant items in DB.")
-
-    # Convert DB models to dictionaries for Gemini service
-    items_for_gemini = [
-        {
-            "name": item.name,
-            "price": item.price,
-            "sellingUnit": item.sellingUnit,
-            "sellingValue": item.sellingValue,
-            "measuredQuantityValue": item.measuredQuantityValue,
-            "measuredQuantityUnit": item.measuredQuantityUnit,
-            "store": item.store,
-            "notes": item.notes,
-        } for item in db_items
-    ]
+    print(f"[*] Found {len(items_for_gemini)} relevant items in DB.")
 
     # 2. Call Gemini service to generate meal plan
-    # Run the synchronous Gemini call in FastAPI's threadpool
+    # The service awaits Gemini's async API, so the event loop is not blocked
     meal_plan_result = await gemini_service.generate_meal_plan_from_items(
         items=items_for_gemini,
         store_name=request.store_name
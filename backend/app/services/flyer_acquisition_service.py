@@ -1,34 +1,88 @@
 # backend/app/services/flyer_acquisition_service.py
 import requests
-import os
-import tempfile
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+import aiohttp
+import asyncio
+from cachetools.func import ttl_cache
+from concurrent.futures import ThreadPoolExecutor
 from PIL import Image
 from io import BytesIO
-import time
 import logging
+import os
+import tempfile
 
 # --- Configuration ---
 # TODO: Consider moving these to a config file or environment variables if they change often
 FLIPP_BASE_URL = "https://flyers-ng.flippback.com/api/flipp/data"
 TILE_BASE_URL = "https://f.wishabi.net/"
-DEFAULT_REQUEST_DELAY_S = 0.1 # Small delay between tile requests to be polite
 DEFAULT_TILE_ZOOM_LEVEL = 4 # Common zoom level for tiles
 REQUEST_TIMEOUT_S = 30
+FLIPP_INDEX_CACHE_TTL_S = 900 # How long a postal code's Flipp flyer list is reused
+TILE_REQUEST_TIMEOUT_S = 15
+TILE_FETCH_CONCURRENCY = 8 # Max tile requests in flight at once, to stay polite to the tile CDN
+TILE_ROW_PROBE_CHUNK = 8 # Tiles requested speculatively per batch while discovering a row's length
+TILE_GRID_MAX = 64 # Hard cap on tiles per row/column, in case the CDN never returns a 404
+STITCHED_JPEG_QUALITY = 88
 USER_AGENT = "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36"
 # --- End Configuration ---
 
 logger = logging.getLogger(__name__)
 
+# Keep-alive session for Flipp API calls; tiles use the aiohttp session below
+_flipp_session = requests.Session()
+_flipp_session.headers["User-Agent"] = USER_AGENT
+_flipp_session.mount("https://", HTTPAdapter(pool_connections=16, pool_maxsize=16, max_retries=Retry(total=2, backoff_factor=0.2)))
+
+# Pillow releases the GIL while decoding JPEG, so tiles decode in parallel across cores
+_tile_decode_executor = ThreadPoolExecutor(max_workers=min(16, os.cpu_count() or 4), thread_name_prefix="tile-decode")
+
+_tile_session: aiohttp.ClientSession | None = None
+_tile_semaphore = asyncio.Semaphore(TILE_FETCH_CONCURRENCY)
+
+def _get_tile_session() -> aiohttp.ClientSession:
+    """Returns the shared aiohttp session for tile downloads, creating it on first use."""
+    global _tile_session
+    if _tile_session is None or _tile_session.closed:
+        _tile_session = aiohttp.ClientSession(
+            # Every tile comes from one CDN host; keep its DNS answer and warm connections between fetches
+            connector=aiohttp.TCPConnector(limit=16, ttl_dns_cache=300, keepalive_timeout=60),
+            timeout=aiohttp.ClientTimeout(total=TILE_REQUEST_TIMEOUT_S),
+            headers={'User-Agent': USER_AGENT},
+        )
+    return _tile_session
+
+async def close_http_sessions() -> None:
+    """Closes the shared tile download session. Call on application shutdown."""
+    global _tile_session
+    if _tile_session is not None and not _tile_session.closed:
+        await _tile_session.close()
+    _tile_session = None
+
+@ttl_cache(maxsize=256, ttl=FLIPP_INDEX_CACHE_TTL_S)
+def _fetch_flipp_index(postal_code: str) -> dict[tuple[str, str], tuple[str, str]]:
+    """
+    Fetches the Flipp flyer list for a postal code and indexes it (see _build_flyer_index).
+    Cached per postal code so several merchants looked up for the same area share one request;
+    errors raise and are therefore not cached.
+    """
+    url = f"{FLIPP_BASE_URL}?locale=en&postal_code={postal_code}&sid=5672125193598641" # SID might need to be dynamic or configured
+    logger.info(f"Fetching initial flyer data from {url}")
+    response = _flipp_session.get(url, timeout=REQUEST_TIMEOUT_S)
+    response.raise_for_status()
+    data = response.json()
+    logger.info("Flipp data fetched successfully.")
+
+    flyers = data.get("flyers", [])
+    if not flyers:
+        logger.warning(f"No flyers found in the Flipp response for postal code '{postal_code}'.")
+    return _build_flyer_index(flyers)
+
 def find_flyer_path_from_flipp(postal_code: str, merchant_name: str, category: str = "Groceries") -> tuple[str | None, str | None]:
     """Fetches initial data from Flipp and finds the ID and path of the target flyer."""
-    url = f"{FLIPP_BASE_URL}?locale=en&postal_code={postal_code}&sid=5672125193598641" # SID might need to be dynamic or configured
-    logger.info(f"Fetching initial flyer data from {url} for merchant '{merchant_name}' in '{postal_code}'")
+    logger.info(f"Looking up flyer for merchant '{merchant_name}' in '{postal_code}'")
     try:
-        headers = {'User-Agent': USER_AGENT}
-        response = requests.get(url, timeout=REQUEST_TIMEOUT_S, headers=headers)
-        response.raise_for_status()
-        data = response.json()
-        logger.info("Flipp data fetched successfully.")
+        flyer_index = _fetch_flipp_index(postal_code)
     except requests.exceptions.RequestException as e:
         logger.error(f"Error fetching initial Flipp data: {e}")
         return None, None
@@ -36,51 +90,71 @@ def find_flyer_path_from_flipp(postal_code: str, merchant_name: str, category: s
         logger.error("Error decoding JSON response from Flipp.")
         return None, None
 
-    flyers = data.get("flyers", [])
-    if not flyers:
-        logger.warning("No flyers found in the Flipp response.")
-        return None, None
-
-    logger.info(f"Searching for '{merchant_name}' flyer with category '{category}'...")
-    for flyer in flyers:
-        flyer_merchant = flyer.get("merchant", "").strip()
-        flyer_categories = [cat.strip() for cat in flyer.get("categories", [])]
-
-        if flyer_merchant.lower() == merchant_name.lower() and category in flyer_categories:
-            flyer_id = flyer.get("id")
-            flyer_path = flyer.get("path")
-            if flyer_id and flyer_path:
-                logger.info(f"Found matching flyer! ID: {flyer_id}, Path: {flyer_path}")
-                return str(flyer_id), flyer_path
-            else:
-                logger.warning(f"Found matching flyer for '{merchant_name}' but missing ID or Path. ID: {flyer_id}, Path: {flyer_path}")
+    flyer_id, flyer_path = flyer_index.get((merchant_name.strip().lower(), category), (None, None))
+    if flyer_id:
+        logger.info(f"Found matching flyer! ID: {flyer_id}, Path: {flyer_path}")
+        return flyer_id, flyer_path
 
     logger.warning(f"No flyer found for '{merchant_name}' with category '{category}' in postal code '{postal_code}'.")
     return None, None
 
-def _download_single_tile(url: str, target_path: str) -> bool:
-    """Downloads a single tile image. Returns True on success, False on failure (especially 404)."""
-    try:
-        headers = {'User-Agent': USER_AGENT}
-        response = requests.get(url, stream=True, timeout=15, headers=headers)
-        if response.status_code == 404:
-            return False # Explicitly return False for 404
-        response.raise_for_status()
-        with open(target_path, 'wb') as f:
-            for chunk in response.iter_content(1024):
-                f.write(chunk)
-        return True
-    except requests.exceptions.RequestException as e:
-        if not (isinstance(e, requests.exceptions.HTTPError) and e.response.status_code == 404):
-             logger.warning(f"Error downloading tile {url}: {e}")
-        return False
-    except IOError as e:
-        logger.error(f"Error saving image tile to {target_path}: {e}")
-        return False
-
-def download_and_stitch_flyer_image(flyer_path: str, zoom_level: int = DEFAULT_TILE_ZOOM_LEVEL) -> Image.Image | None:
+def _build_flyer_index(flyers: list[dict]) -> dict[tuple[str, str], tuple[str, str]]:
+    """
+    Indexes the Flipp flyer list in one pass as {(merchant_lower, category): (flyer_id, flyer_path)}.
+    The first flyer with both an ID and a path wins for each key.
+    """
+    index = {}
+    for flyer in flyers:
+        flyer_id = flyer.get("id")
+        flyer_path = flyer.get("path")
+        if not flyer_id or not flyer_path:
+            continue
+        flyer_merchant = flyer.get("merchant", "").strip().lower()
+        for flyer_category in flyer.get("categories", []):
+            index.setdefault((flyer_merchant, flyer_category.strip()), (str(flyer_id), flyer_path))
+    return index
+
+async def _fetch_tile(session: aiohttp.ClientSession, url: str) -> bytes | None:
+    """Downloads a single tile image. Returns its bytes, or None on failure (especially 404)."""
+    async with _tile_semaphore:
+        try:
+            async with session.get(url) as response:
+                if response.status == 404:
+                    return None # Explicitly return None for 404
+                response.raise_for_status()
+                return await response.read()
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            logger.warning(f"Error downloading tile {url}: {e}")
+            return None
+
+def _tile_url(flyer_path: str, zoom_level: int, x_coord: int, y_coord: int) -> str:
+    return f"{TILE_BASE_URL}{flyer_path}{zoom_level}_{x_coord}_{y_coord}.jpg"
+
+async def _fetch_tile_run(session: aiohttp.ClientSession, url_for, start: int = 0) -> list[bytes]:
+    """
+    Downloads consecutive tiles url_for(start), url_for(start + 1), ... up to the first missing one.
+    Tiles are requested TILE_ROW_PROBE_CHUNK at a time in parallel since the run length is unknown,
+    and the run never extends past index TILE_GRID_MAX.
+    """
+    tiles = []
+    index = start
+    while index < TILE_GRID_MAX:
+        batch = await asyncio.gather(*[
+            _fetch_tile(session, url_for(i)) for i in range(index, min(index + TILE_ROW_PROBE_CHUNK, TILE_GRID_MAX))
+        ])
+        for tile_bytes in batch:
+            if tile_bytes is None:
+                return tiles # Assume end of run
+            tiles.append(tile_bytes)
+        index += TILE_ROW_PROBE_CHUNK
+    logger.warning(f"Tile run reached TILE_GRID_MAX ({TILE_GRID_MAX}); stopping discovery there.")
+    return tiles
+
+async def download_and_stitch_flyer_image(flyer_path: str, zoom_level: int = DEFAULT_TILE_ZOOM_LEVEL) -> Image.Image | None:
     """
     Downloads all tiles for a flyer page and stitches them together.
+    The grid size is discovered from the first row and first column only; the remaining
+    tiles are then fetched in a single concurrent batch.
     Returns a PIL Image object or None if an error occurs.
     """
     if not flyer_path:
@@ -89,112 +163,120 @@ def download_and_stitch_flyer_image(flyer_path: str, zoom_level: int = DEFAULT_T
 
     logger.info(f"Starting tile discovery for path: {flyer_path} at zoom level {zoom_level}")
 
-    downloaded_tiles = {}  # Dictionary to store { (x, y): temp_path }
-    max_x_found = -1
-    max_y_found = -1
-    tile_width = -1
-    tile_height = -1
-    found_any_tile = False
-
-    with tempfile.TemporaryDirectory() as temp_dir:
-        logger.info(f"Using temporary directory for tiles: {temp_dir}")
-        y_coord = 0
-        while True:  # Loop through rows (y-coordinate in filename)
-            x_coord = 0
-            row_found_tile = False
-            current_row_max_x = -1
-            while True:  # Loop through columns (x-coordinate in filename)
-                tile_filename = f"{zoom_level}_{x_coord}_{y_coord}.jpg"
-                tile_url = f"{TILE_BASE_URL}{flyer_path}{tile_filename}"
-                temp_filepath = os.path.join(temp_dir, f"tile_{x_coord}_{y_coord}.jpg")
-
-                if _download_single_tile(tile_url, temp_filepath):
-                    downloaded_tiles[(x_coord, y_coord)] = temp_filepath
-                    row_found_tile = True
-                    found_any_tile = True
-                    current_row_max_x = x_coord
-                    if max_y_found < y_coord: max_y_found = y_coord
-
-                    if tile_width == -1:
-                        try:
-                            with Image.open(temp_filepath) as img:
-                                tile_width, tile_height = img.size
-                            logger.info(f"Detected tile dimensions: {tile_width}x{tile_height}")
-                        except Exception as e:
-                            logger.error(f"Error reading dimensions from {temp_filepath}: {e}. Aborting stitch.")
-                            return None
-
-                    if DEFAULT_REQUEST_DELAY_S > 0:
-                        time.sleep(DEFAULT_REQUEST_DELAY_S)
-                    x_coord += 1
-                else:
-                    break # Stop searching this row (assume end of row)
-            
-            if row_found_tile:
-                if current_row_max_x > max_x_found: max_x_found = current_row_max_x
-                y_coord += 1
-            else:
-                if found_any_tile:
-                    logger.info(f"No tiles found for filename y-coordinate {y_coord}. Assuming end of flyer.")
-                    break
-                else:
-                    if y_coord == 0 and x_coord == 0:
-                        logger.error(f"Failed to find the very first tile ({zoom_level}_0_0.jpg). Cannot proceed.")
-                        return None
-                    logger.warning(f"No tiles found for y-coordinate {y_coord}, and no tiles found yet. Continuing search...")
-                    y_coord += 1
-                    if y_coord > 15: # Safety break for initial empty rows
-                        logger.error("Searched too many initial rows without finding tiles. Stopping.")
-                        return None
-
-        if not downloaded_tiles or tile_width <= 0 or tile_height <= 0:
-            logger.error("No tiles were downloaded or tile dimensions invalid. Cannot stitch.")
-            return None
+    session = _get_tile_session()
+    # Bottom row (y=0) and left column (x=0, from y=1) are probed concurrently to find the grid size
+    first_row, first_column = await asyncio.gather(
+        _fetch_tile_run(session, lambda x: _tile_url(flyer_path, zoom_level, x, 0)),
+        _fetch_tile_run(session, lambda y: _tile_url(flyer_path, zoom_level, 0, y), start=1),
+    )
+    if not first_row:
+        logger.error(f"Failed to find the very first tile ({zoom_level}_0_0.jpg). Cannot proceed.")
+        return None
+
+    grid_width_tiles = len(first_row)
+    grid_height_tiles = len(first_column) + 1
+
+    downloaded_tiles = {(x, 0): tile_bytes for x, tile_bytes in enumerate(first_row)} # { (x, y): tile_bytes }
+    downloaded_tiles.update({(0, y): tile_bytes for y, tile_bytes in enumerate(first_column, start=1)})
+
+    # With the grid known, fetch every remaining tile at once (bounded by the tile semaphore)
+    remaining_coords = [(x, y) for y in range(1, grid_height_tiles) for x in range(1, grid_width_tiles)]
+    remaining_tiles = await asyncio.gather(*[
+        _fetch_tile(session, _tile_url(flyer_path, zoom_level, x, y)) for x, y in remaining_coords
+    ])
+    for coords, tile_bytes in zip(remaining_coords, remaining_tiles):
+        if tile_bytes is None:
+            logger.warning(f"Missing tile at filename coords {coords}; leaving it blank.")
+            continue
+        downloaded_tiles[coords] = tile_bytes
+
+    try:
+        with Image.open(BytesIO(first_row[0])) as img:
+            tile_width, tile_height = img.size
+        logger.info(f"Detected tile dimensions: {tile_width}x{tile_height}")
+    except Exception as e:
+        logger.error(f"Error reading dimensions from first tile: {e}. Aborting stitch.")
+        return None
+
+    if tile_width <= 0 or tile_height <= 0:
+        logger.error("Tile dimensions invalid. Cannot stitch.")
+        return None
+
+    # Decoding and pasting is CPU-bound; keep it off the event loop
+    return await asyncio.to_thread(
+        _stitch_tiles, downloaded_tiles, grid_width_tiles, grid_height_tiles, tile_width, tile_height
+    )
+
+def _decode_tile(item: tuple[tuple[int, int], bytes]) -> tuple[tuple[int, int], Image.Image | None]:
+    """Fully decodes one ((x, y), tile_bytes) entry; runs on the decode pool."""
+    coords, tile_bytes = item
+    try:
+        tile_img = Image.open(BytesIO(tile_bytes))
+        tile_img.load()
+        return coords, tile_img
+    except Exception as e:
+        logger.error(f"Error opening tile (filename coords: {coords[0]},{coords[1]}): {e}")
+        return coords, None
+
+def _stitch_tiles(downloaded_tiles: dict, grid_width_tiles: int, grid_height_tiles: int, tile_width: int, tile_height: int) -> Image.Image:
+    """Pastes { (x, y): tile_bytes } onto a single canvas. Y=0 is the bottom row in tile filenames."""
+    max_y_found = grid_height_tiles - 1
+    total_pixel_width = grid_width_tiles * tile_width
+    total_pixel_height = grid_height_tiles * tile_height
+
+    logger.info(f"Stitching {len(downloaded_tiles)} tiles. Grid: {grid_width_tiles}x{grid_height_tiles} tiles. Canvas: {total_pixel_width}x{total_pixel_height} px.")
+    combined_image = Image.new('RGB', (total_pixel_width, total_pixel_height), color='white')
+
+    for (x, y), tile_img in _tile_decode_executor.map(_decode_tile, downloaded_tiles.items()):
+        if tile_img is None:
+            continue
+        paste_x = x * tile_width
+        paste_y = (max_y_found - y) * tile_height # Y=0 is bottom row in filename, top in PIL
+        combined_image.paste(tile_img, (paste_x, paste_y))
+        tile_img.close()
+
+    logger.info("Image stitching complete.")
+    return combined_image
+
+def _save_jpeg(image: Image.Image, output_dir: str | None) -> str:
+    """
+    Encodes the image straight into a new temp file in output_dir and returns its path.
+    JPEG: the tiles are JPEG already and Gemini accepts it; much cheaper than PNG's zlib on a large canvas.
+    """
+    fd, tmp_path = tempfile.mkstemp(suffix=".jpg", dir=output_dir)
+    try:
+        with os.fdopen(fd, "wb") as f:
+            image.save(f, format='JPEG', quality=STITCHED_JPEG_QUALITY, optimize=False, progressive=False)
+        os.chmod(tmp_path, 0o644) # mkstemp creates 0600; saved flyers are served and read like any other upload
+    except Exception:
+        os.remove(tmp_path)
+        raise
+    return tmp_path
 
-        grid_width_tiles = max_x_found + 1
-        grid_height_tiles = max_y_found + 1
-        total_pixel_width = grid_width_tiles * tile_width
-        total_pixel_height = grid_height_tiles * tile_height
-
-        logger.info(f"Stitching {len(downloaded_tiles)} tiles. Grid: {grid_width_tiles}x{grid_height_tiles} tiles. Canvas: {total_pixel_width}x{total_pixel_height} px.")
-        combined_image = Image.new('RGB', (total_pixel_width, total_pixel_height), color='white')
-
-        for (x, y), temp_path in downloaded_tiles.items():
-            try:
-                with Image.open(temp_path) as tile_img:
-                    paste_x = x * tile_width
-                    paste_y = (max_y_found - y) * tile_height # Y=0 is bottom row in filename, top in PIL
-                    combined_image.paste(tile_img, (paste_x, paste_y))
-            except Exception as e:
-                logger.error(f"Error opening or pasting tile {temp_path} (filename coords: {x},{y}): {e}")
-        
-        logger.info("Image stitching complete.")
-        return combined_image
-
-async def get_flyer_image_data_and_id(postal_code: str, merchant_name: str, category: str = "Groceries", zoom_level: int = DEFAULT_TILE_ZOOM_LEVEL) -> tuple[str | None, bytes | None]:
+async def get_flyer_image_file_and_id(postal_code: str, merchant_name: str, category: str = "Groceries", zoom_level: int = DEFAULT_TILE_ZOOM_LEVEL, output_dir: str | None = None) -> tuple[str | None, str | None]:
     """
-    Main function to get flyer ID and its stitched image data as bytes.
-    Returns (flipp_flyer_id, image_bytes) or (None, None) on failure.
+    Main function to get flyer ID and its stitched image, written as a JPEG temp file in output_dir.
+    The encoded image is never held in memory alongside the canvas; callers move the file into place
+    (os.replace is atomic when output_dir is on the destination's filesystem).
+    Blocking steps (the Flipp lookup, stitching and JPEG encoding) run in worker threads so the event loop stays free.
+    Returns (flipp_flyer_id, temp_image_path) or (None, None) on failure.
     """
-    flipp_flyer_id, flyer_path = find_flyer_path_from_flipp(postal_code, merchant_name, category)
+    flipp_flyer_id, flyer_path = await asyncio.to_thread(find_flyer_path_from_flipp, postal_code, merchant_name, category)
     if not flyer_path or not flipp_flyer_id:
         logger.warning(f"Could not find flyer path or ID for {merchant_name} in {postal_code}.")
         return None, None
 
-    stitched_image_pil = download_and_stitch_flyer_image(flyer_path, zoom_level)
+    stitched_image_pil = await download_and_stitch_flyer_image(flyer_path, zoom_level)
     if not stitched_image_pil:
         logger.error(f"Failed to download and stitch flyer for {merchant_name}, path {flyer_path}.")
         return None, None
 
     try:
-        img_byte_arr = BytesIO()
-        stitched_image_pil.save(img_byte_arr, format='PNG') # Save as PNG
-        img_bytes = img_byte_arr.getvalue()
-        logger.info(f"Successfully converted stitched image to PNG bytes for flyer ID {flipp_flyer_id}.")
-        return flipp_flyer_id, img_bytes
+        tmp_image_path = await asyncio.to_thread(_save_jpeg, stitched_image_pil, output_dir)
+        logger.info(f"Successfully saved stitched image as JPEG to {tmp_image_path} for flyer ID {flipp_flyer_id}.")
+        return flipp_flyer_id, tmp_image_path
     except Exception as e:
-        logger.error(f"Error converting PIL image to bytes: {e}")
+        logger.error(f"Error saving stitched image as JPEG: {e}")
         return None, None
     finally:
-        if 'stitched_image_pil' in locals() and stitched_image_pil:
-            stitched_image_pil.close()
+        stitched_image_pil.close()
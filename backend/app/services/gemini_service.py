@@ -2,11 +2,18 @@ import os
 from dotenv import load_dotenv
 import google.generativeai as genai
 import google.ai.generativelanguage as glm # Import the correct module for types
+import copy
+import hashlib
 import json
-import mimetypes # To detect file type
+import multiprocessing
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
 import re # For parsing the meal plan response
 from typing import List # Import List
 import fitz # Import PyMuPDF
+from cachetools import LRUCache
+from google.protobuf.json_format import MessageToDict
 
 # Load environment variables (especially GOOGLE_API_KEY)
 load_dotenv()
@@ -96,6 +103,15 @@ flyer_extraction_schema = {
     "items": flyer_item_schema
 }
 
+# Extraction prompts; the schema-derived part is filled in once here, the rest per request via str.format
+_EXTRACTION_INSTRUCTIONS = (
+    "Extract all grocery items according to the 'extract_flyer_items' function schema. "
+    f"Populate all required fields: {', '.join(flyer_item_schema['required'])}. "
+    "Call the 'extract_flyer_items' function with the extracted data."
+)
+_SINGLE_FILE_PROMPT_TEMPLATE = "Analyze the provided {store_name} flyer {kind} ({mime_type}). " + _EXTRACTION_INSTRUCTIONS
+_PAGE_IMAGES_PROMPT_TEMPLATE = "Analyze the provided {store_name} flyer document (sent as multiple images, one per page). " + _EXTRACTION_INSTRUCTIONS
+
 # Generation configuration for Gemini
 generation_config = {
     "temperature": 0.2, # Lower temperature for more deterministic extraction
@@ -105,6 +121,26 @@ generation_config = {
     # "response_schema": flyer_extraction_schema # Use function calling for structured output instead
 }
 
+# Successful extractions, keyed by (content_sha256, mime_type, store_name). Extraction runs in
+# worker threads, so access is guarded by a lock.
+EXTRACTION_CACHE_SIZE = 64
+_extraction_cache: LRUCache = LRUCache(maxsize=EXTRACTION_CACHE_SIZE)
+_extraction_cache_lock = threading.Lock()
+
+# Gemini caps inline request data at 20 MB; larger files on disk are sent via the File API instead
+GEMINI_INLINE_DATA_MAX_BYTES = 15 * 1024 * 1024
+
+# Gemini reads PDFs natively; set GEMINI_PDF_CLIENT_RASTER=true to render pages to images locally instead
+PDF_CLIENT_RASTER = os.getenv("GEMINI_PDF_CLIENT_RASTER", "false").lower() == "true"
+# Page rendering settings for the client-side raster path
+PDF_RENDER_DPI = int(os.getenv("FLYER_RASTER_DPI", "100")) # ~850x1100 px per letter page; Gemini downscales larger images to its tile budget anyway
+PDF_PAGE_JPEG_QUALITY = 80
+PDF_RASTER_MAX_PAGES = 20 # Longer PDFs are sent as-is even when client-side rendering is enabled
+PDF_RENDER_WORKERS = min(os.cpu_count() or 1, 4) # MuPDF rendering is CPU-bound; gains flatten beyond ~4 processes
+
+_pdf_render_pool: ProcessPoolExecutor | None = None
+_pdf_render_pool_lock = threading.Lock()
+
 # Safety settings (adjust as needed)
 safety_settings = [
     {"category": "HARM_CATEGORY_HARASSMENT", "threshold": "BLOCK_MEDIUM_AND_ABOVE"},
@@ -113,7 +149,14 @@ safety_settings = [
     {"category": "HARM_CATEGORY_DANGEROUS_CONTENT", "threshold": "BLOCK_MEDIUM_AND_ABOVE"},
 ]
 
-# Tool definition for Gemini function calling
+# JSON schema type names -> Gemini parameter types
+_SCHEMA_TYPES = {
+    'string': glm.Type.STRING,
+    'number': glm.Type.NUMBER,
+    'boolean': glm.Type.BOOLEAN,
+}
+
+# Tool definition for Gemini function calling (built once; the cached _flyer_model holds it)
 extract_flyer_items_tool = genai.types.Tool(
     function_declarations=[
         genai.types.FunctionDeclaration(
@@ -132,7 +175,7 @@ extract_flyer_items_tool = genai.types.Tool(
                                 # Map schema properties to FunctionDeclaration parameter definitions
                                 prop: {
                                     # Use glm.Type for type definitions
-                                    "type_": glm.Type.STRING if details['type'] == 'string' else glm.Type.NUMBER if details['type'] == 'number' else glm.Type.BOOLEAN,
+                                    "type_": _SCHEMA_TYPES[details['type']],
                                     "description": details.get('description', ''),
                                     "nullable": details.get('nullable', False) # Add nullable if present in schema
                                 }
@@ -149,103 +192,257 @@ extract_flyer_items_tool = genai.types.Tool(
 )
 
 
+# Forces the extract_flyer_items function call on every extraction request
+_flyer_tool_config = glm.ToolConfig(
+    function_calling_config=glm.FunctionCallingConfig(
+        mode=glm.FunctionCallingConfig.Mode.ANY, # Use ANY (or REQUIRED if it must call it)
+        allowed_function_names=["extract_flyer_items"] # Specify the function to call
+    )
+)
+
+# Built once at import and reused for every extraction
+# Use gemini-1.5-pro-latest
+_flyer_model = genai.GenerativeModel(
+    model_name="gemini-1.5-pro-latest",
+    generation_config=generation_config,
+    safety_settings=safety_settings,
+    tools=[extract_flyer_items_tool]
+)
+
+
+# Flyer file types Gemini accepts, by lowercased extension
+_EXTENSION_MIME_TYPES = {
+    '.pdf': 'application/pdf',
+    '.png': 'image/png',
+    '.jpg': 'image/jpeg',
+    '.jpeg': 'image/jpeg',
+    '.webp': 'image/webp',
+}
+
+def _guess_mime_type(file_path: str) -> str:
+    """Determines the MIME type of a flyer file from its extension."""
+    mime_type = _EXTENSION_MIME_TYPES.get(os.path.splitext(file_path)[1].lower())
+    if not mime_type:
+        raise ValueError(f"Could not determine MIME type for file: {file_path}")
+    return mime_type
+
+
+def _iter_rendered_pages(doc: fitz.Document, page_nums: range):
+    """Yields each page as JPEG bytes; the page and pixmap objects are released before the next page renders."""
+    for page_num in page_nums:
+        page = doc.load_page(page_num)
+        # Increase resolution (dpi) for better quality if needed; no alpha channel needed for flyers
+        pix = page.get_pixmap(dpi=PDF_RENDER_DPI, alpha=False)
+        # JPEG is several times smaller than PNG for photographic flyer pages
+        img_bytes = pix.tobytes("jpeg", jpg_quality=PDF_PAGE_JPEG_QUALITY)
+        pix = None
+        page = None
+        yield img_bytes
+
+
+def _render_pdf_pages(data: bytes, page_nums: range) -> List[bytes]:
+    """Renders the given pages of a PDF to JPEG bytes. Runs in a render worker process for multi-page PDFs."""
+    doc = fitz.open(stream=data, filetype="pdf")
+    try:
+        return list(_iter_rendered_pages(doc, page_nums))
+    finally:
+        doc.close()
+        fitz.TOOLS.store_shrink(100) # Drop MuPDF's cached resources for this document
+
+
+def _get_pdf_render_pool() -> ProcessPoolExecutor:
+    """Returns the shared PDF render process pool, creating it on first use."""
+    global _pdf_render_pool
+    with _pdf_render_pool_lock:
+        if _pdf_render_pool is None:
+            # spawn, not fork: the server process runs several threads, which fork does not copy safely
+            _pdf_render_pool = ProcessPoolExecutor(max_workers=PDF_RENDER_WORKERS, mp_context=multiprocessing.get_context("spawn"))
+        return _pdf_render_pool
+
+
+def _pdf_page_count(*open_args, **open_kwargs) -> int:
+    """Opens a PDF (same arguments as fitz.open) just to count its pages; no page is loaded."""
+    with fitz.open(*open_args, **open_kwargs) as doc:
+        return len(doc)
+
+
+def _rasterize_pdf(page_count: int) -> bool:
+    """Client-side rendering is opt-in and only pays off for short documents; long ones go to Gemini as PDF."""
+    return PDF_CLIENT_RASTER and page_count <= PDF_RASTER_MAX_PAGES
+
+
+def _render_pdf_to_jpegs(data: bytes, page_count: int) -> List[bytes]:
+    """
+    Renders every page of a PDF to JPEG bytes, in page order.
+    Multi-page documents are split into one contiguous page range per worker process, so the
+    PDF bytes are sent to each worker once and MuPDF renders the ranges in parallel.
+    """
+    if page_count <= 1 or PDF_RENDER_WORKERS <= 1:
+        return _render_pdf_pages(data, range(page_count))
+
+    pages_per_worker = -(-page_count // PDF_RENDER_WORKERS) # Ceiling division
+    page_ranges = [range(start, min(start + pages_per_worker, page_count)) for start in range(0, page_count, pages_per_worker)]
+    rendered_ranges = _get_pdf_render_pool().map(_render_pdf_pages, repeat(data), page_ranges)
+    return [img_bytes for rendered in rendered_ranges for img_bytes in rendered]
+
+
+def _extract_with_cache(cache_key: tuple, extract) -> dict:
+    """
+    Returns the cached result for (content_sha256, mime_type, store_name), or runs extract() and caches
+    it if it succeeded. Results are deep-copied in and out so callers can't mutate the cached copy.
+    """
+    with _extraction_cache_lock:
+        cached_result = _extraction_cache.get(cache_key)
+    if cached_result is not None:
+        print(f"[*] Using cached extraction result for {cache_key[2]} flyer {cache_key[0][:12]}")
+        return copy.deepcopy(cached_result)
+
+    result = extract()
+    if "error" not in result:
+        with _extraction_cache_lock:
+            _extraction_cache[cache_key] = copy.deepcopy(result)
+    return result
+
+
+def _single_file_prompt(store_name: str, mime_type: str) -> str:
+    kind = "document" if mime_type == 'application/pdf' else "image"
+    return _SINGLE_FILE_PROMPT_TEMPLATE.format(store_name=store_name, kind=kind, mime_type=mime_type)
+
+
+def _extract_flyer_data_via_file_api(file_path: str, mime_type: str, store_name: str) -> dict:
+    """
+    Uploads the image or PDF to Gemini's File API (streamed from disk) and extracts from the file reference.
+    The uploaded file is deleted once the extraction request finishes.
+    """
+    print(f"[*] Uploading {file_path} to the Gemini File API...")
+    try:
+        file_ref = genai.upload_file(path=file_path, mime_type=mime_type)
+    except Exception as e:
+        print(f"[!] Error uploading file to Gemini: {e}")
+        return {"error": f"Failed to upload file to Gemini: {e}"}
+
+    try:
+        return _request_flyer_extraction([_single_file_prompt(store_name, mime_type), file_ref])
+    finally:
+        try:
+            genai.delete_file(file_ref.name)
+        except Exception as e:
+            print(f"[!] Could not delete uploaded Gemini file {file_ref.name}: {e}")
+
+
 def extract_flyer_data_from_image(file_path: str, store_name: str) -> dict:
-    """Extracts structured flyer data from an image or PDF using Gemini Pro Vision."""
+    """Extracts structured flyer data from an image or PDF on disk using Gemini Pro Vision."""
     print(f"[*] Starting flyer data extraction for {store_name} from {file_path}")
-    parts = [] # List to hold all parts (prompt + images/pdf)
 
     try:
         # Determine MIME type
-        mime_type, _ = mimetypes.guess_type(file_path)
-        if not mime_type:
-            # Fallback if guess fails
-            if file_path.lower().endswith('.pdf'):
-                mime_type = 'application/pdf'
-            elif file_path.lower().endswith(('.png', '.jpg', '.jpeg', '.webp')):
-                 mime_type = f'image/{file_path.split(".")[-1].lower().replace("jpg", "jpeg")}'
-            else:
-                 raise ValueError(f"Could not determine MIME type for file: {file_path}")
-        print(f"[*] Detected MIME type: {mime_type}")
-
-        if mime_type == 'application/pdf':
-            print("[*] Processing PDF file...")
-            doc = fitz.open(file_path)
-            image_parts = []
-            for page_num in range(len(doc)):
-                page = doc.load_page(page_num)
-                # Increase resolution (dpi) for better quality if needed
-                pix = page.get_pixmap(dpi=150) # Adjust DPI as necessary
-                img_bytes = pix.tobytes("png") # Convert to PNG bytes
-                image_parts.append({
-                    "mime_type": "image/png",
-                    "data": img_bytes
-                })
-            doc.close()
-            if not image_parts:
+        mime_type = _guess_mime_type(file_path)
+        # Large files Gemini reads natively go through the File API instead of being read into memory and sent inline
+        sent_as_is = mime_type.startswith('image/') or (
+            mime_type == 'application/pdf' and not (PDF_CLIENT_RASTER and _rasterize_pdf(_pdf_page_count(file_path)))
+        )
+        if sent_as_is and os.path.getsize(file_path) > GEMINI_INLINE_DATA_MAX_BYTES:
+            with open(file_path, 'rb') as f:
+                file_digest = hashlib.file_digest(f, "sha256").hexdigest() # Streamed; the file is not held in memory
+            return _extract_with_cache(
+                (file_digest, mime_type, store_name),
+                lambda: _extract_flyer_data_via_file_api(file_path, mime_type, store_name)
+            )
+        with open(file_path, 'rb') as f:
+            file_bytes = f.read()
+    except FileNotFoundError:
+        print(f"[!] Error: File not found at {file_path}")
+        return {"error": "File not found"}
+    except Exception as e:
+        print(f"[!] Error reading or processing file {file_path}: {e}")
+        return {"error": f"Failed to read or process file: {e}"}
+
+    return extract_flyer_data_from_bytes(file_bytes, mime_type, store_name)
+
+
+def extract_flyer_data_from_bytes(data: bytes, mime_type: str, store_name: str) -> dict:
+    """
+    Extracts structured flyer data from in-memory image or PDF bytes using Gemini Pro Vision.
+    Lets callers that already hold the file contents (e.g. uploads) skip a round trip through disk.
+    Successful results are cached by content hash, so re-submitting the same flyer skips Gemini.
+    """
+    return _extract_with_cache(
+        (hashlib.sha256(data).hexdigest(), mime_type, store_name),
+        lambda: _extract_flyer_data_from_bytes(data, mime_type, store_name)
+    )
+
+
+def _extract_flyer_data_from_bytes(data: bytes, mime_type: str, store_name: str) -> dict:
+    """Uncached body of extract_flyer_data_from_bytes."""
+    print(f"[*] Extracting flyer data for {store_name} from {len(data)} bytes")
+    print(f"[*] Detected MIME type: {mime_type}")
+    parts = [] # List to hold all parts (prompt + images/pdf)
+
+    try:
+        # Page count only matters (and the PDF is only opened) when client-side rendering is enabled
+        pdf_page_count = _pdf_page_count(stream=data, filetype="pdf") if mime_type == 'application/pdf' and PDF_CLIENT_RASTER else 0
+        if mime_type == 'application/pdf' and not _rasterize_pdf(pdf_page_count):
+            print("[*] Processing PDF file (sent to Gemini as-is)...")
+            parts.append(_single_file_prompt(store_name, mime_type))
+            parts.append({"mime_type": mime_type, "data": data})
+
+        elif mime_type == 'application/pdf':
+            print("[*] Processing PDF file (rendering pages to images)...")
+            page_images = _render_pdf_to_jpegs(data, pdf_page_count)
+            if not page_images:
                  return {"error": "PDF processed, but no pages could be converted to images."}
-            print(f"[*] Converted {len(image_parts)} PDF pages to images.")
+            print(f"[*] Converted {len(page_images)} PDF pages to images.")
             # Prepare prompt for multi-image input
-            prompt = f"Analyze the provided {store_name} flyer document (sent as multiple images, one per page). Extract all grocery items according to the 'extract_flyer_items' function schema. Populate all required fields: {', '.join(flyer_item_schema['required'])}. Call the 'extract_flyer_items' function with the extracted data."
+            prompt = _PAGE_IMAGES_PROMPT_TEMPLATE.format(store_name=store_name)
             parts.append(prompt)
-            # Add image parts, potentially adding page numbers in the prompt if context is lost
-            parts.extend(image_parts)
+            # Add image parts straight into the request, potentially adding page numbers in the prompt if context is lost
+            parts.extend({"mime_type": "image/jpeg", "data": img_bytes} for img_bytes in page_images)
+            del page_images # parts now holds the only references to the page bytes
 
         elif mime_type.startswith('image/'):
             print("[*] Processing single image file...")
-            with open(file_path, 'rb') as f:
-                file_bytes = f.read()
             file_data_part = {
                 "mime_type": mime_type,
-                "data": file_bytes
+                "data": data
             }
             # Prepare prompt for single image
-            prompt = f"Analyze the provided {store_name} flyer image ({mime_type}). Extract all grocery items according to the 'extract_flyer_items' function schema. Populate all required fields: {', '.join(flyer_item_schema['required'])}. Call the 'extract_flyer_items' function with the extracted data."
+            prompt = _single_file_prompt(store_name, mime_type)
             parts.append(prompt)
             parts.append(file_data_part)
         else:
             # Handle other potential file types or raise error
              return {"error": f"Unsupported file type: {mime_type}"}
 
-
-    except FileNotFoundError:
-        print(f"[!] Error: File not found at {file_path}")
-        return {"error": "File not found"}
     except Exception as e:
-        print(f"[!] Error reading or processing file {file_path}: {e}")
+        print(f"[!] Error processing flyer data: {e}")
         return {"error": f"Failed to read or process file: {e}"}
 
-    # Use gemini-1.5-pro-latest
-    model = genai.GenerativeModel(
-        model_name="gemini-1.5-pro-latest",
-        generation_config=generation_config,
-        safety_settings=safety_settings,
-        tools=[extract_flyer_items_tool]
-    )
+    return _request_flyer_extraction(parts)
 
+
+def _request_flyer_extraction(parts: list) -> dict:
+    """Sends the prompt and flyer parts to Gemini, forcing the extract_flyer_items function call."""
     try:
         print("[*] Sending request to Gemini API...")
         # Force the function call using ANY mode and specifying the allowed function
-        response = model.generate_content(
+        response = _flyer_model.generate_content(
             parts, # Send the combined list of parts (prompt + images)
-            tool_config=glm.ToolConfig(
-                function_calling_config=glm.FunctionCallingConfig(
-                    mode=glm.FunctionCallingConfig.Mode.ANY, # Use ANY (or REQUIRED if it must call it)
-                    allowed_function_names=["extract_flyer_items"] # Specify the function to call
-                )
-            )
+            tool_config=_flyer_tool_config
         )
         print("[*] Received response from Gemini API.")
 
         # Check for function call in response
         if response.candidates and response.candidates[0].content.parts:
             part = response.candidates[0].content.parts[0]
+            # Which member of the Part's `data` oneof is set, read once from the underlying protobuf
+            part_kind = type(part).pb(part).WhichOneof('data')
             # Check if the part actually contains a function call
-            if hasattr(part, 'function_call') and part.function_call.name == 'extract_flyer_items':
+            if part_kind == 'function_call' and part.function_call.name == 'extract_flyer_items':
                 function_call = part.function_call
                 # Convert the function call arguments (which are Struct) to a Python dict
                 try:
-                    # Attempt direct conversion if the library handles it nicely
-                    extracted_data = type(function_call).to_dict(function_call)['args']
+                    # Convert only the args Struct on the underlying protobuf, not the whole wrapper message
+                    extracted_data = MessageToDict(type(function_call).pb(function_call).args)
                 except Exception as convert_err:
                      print(f"[!] Error converting function call args to dict: {convert_err}")
                      # Fallback or alternative conversion method might be needed
@@ -256,9 +453,7 @@ def extract_flyer_data_from_image(file_path: str, store_name: str) -> dict:
                 return extracted_data
             else:
                 # Handle cases where Gemini returned text instead of the expected function call
-                text_response = ""
-                if hasattr(part, 'text'):
-                    text_response = part.text
+                text_response = part.text if part_kind == 'text' else ""
                 print("[!] Gemini responded with text instead of the expected function call.")
                 print(f"Response Text: {text_response}")
                 return {"error": "Gemini did not call the expected function.", "details": text_response}
@@ -300,10 +495,27 @@ flash_generation_config = {
     "max_output_tokens": 8192,
 }
 
+# Use gemini-1.5-flash-latest (or the specific version you intend)
+_meal_plan_model = genai.GenerativeModel(
+    model_name="gemini-1.5-flash-latest",
+    generation_config=flash_generation_config,
+    safety_settings=safety_settings,
+    # No function calling needed here, we'll parse the text response
+)
+
 # Define the expected structure for the meal plan response (for parsing)
 # This is a basic example; more robust parsing might be needed
-MEAL_PLAN_DAY_PATTERN = re.compile(r"Day\s+(\d+):\s*(.*)", re.IGNORECASE)
-SHOPPING_LIST_HEADER_PATTERN = re.compile(r"Shopping List:", re.IGNORECASE)
+# One pattern classifies each line as the shopping list header, a "Day N:" line or a bullet, so the
+# whole response is scanned in a single finditer pass. [^\S\n] is whitespace that stays on the line;
+# it is matched around the captured text so groups come out already trimmed.
+MEAL_PLAN_LINE_PATTERN = re.compile(
+    r"^[^\S\n]*(?:"
+    r"(?P<shopping_header>[^\n]*?Shopping List:[^\n]*)"
+    r"|Day[^\S\n]+(?P<day>\d+):[^\S\n]*(?P<meal>[^\n]*?)"
+    r"|[-*][^\S\n]*(?P<item>[^\n]*?)"
+    r")[^\S\n]*$",
+    re.IGNORECASE | re.MULTILINE
+)
 
 def parse_meal_plan_response(text_response: str) -> dict:
     """Parses the raw text response from Gemini into a structured meal plan and shopping list."""
@@ -311,35 +523,34 @@ def parse_meal_plan_response(text_response: str) -> dict:
     shopping_list = []
     in_shopping_list_section = False
 
-    lines = text_response.strip().split('\n')
-
-    for line in lines:
-        line = line.strip()
-        if not line:
-            continue
-
+    for match in MEAL_PLAN_LINE_PATTERN.finditer(text_response):
         # Check for shopping list header
-        if SHOPPING_LIST_HEADER_PATTERN.search(line):
+        if match["shopping_header"] is not None:
             in_shopping_list_section = True
             continue
 
         if in_shopping_list_section:
             # Simple list parsing (assumes items start with '-' or '*')
-            if line.startswith(('-', '*')):
-                shopping_list.append(line[1:].strip())
+            if match["item"] is not None:
+                shopping_list.append(match["item"])
             # Add more robust parsing if needed
-        else:
-            # Check for meal plan day
-            day_match = MEAL_PLAN_DAY_PATTERN.match(line)
-            if day_match:
-                day_num = day_match.group(1)
-                meal_desc = day_match.group(2).strip()
-                meal_plan[f"Day {day_num}"] = meal_desc
-            # Handle potential introductory text before Day 1 if needed
+        elif match["day"] is not None:
+            # Meal plan day; introductory text before Day 1 never matches
+            meal_plan[f"Day {match['day']}"] = match["meal"]
 
     return {"meal_plan": meal_plan, "shopping_list": shopping_list}
 
 
+def _format_meal_plan_item(item: dict) -> str:
+    """Formats one flyer item as a prompt bullet line."""
+    measured_quantity_value = item.get('measuredQuantityValue')
+    measured_quantity_unit = item.get('measuredQuantityUnit')
+    notes = item.get('notes')
+    quantity_suffix = f" ({measured_quantity_value} {measured_quantity_unit})" if measured_quantity_value and measured_quantity_unit else ""
+    notes_suffix = f" (Notes: {notes})" if notes else ""
+    return f"- {item['name']}: ${item['price']:.2f} / {item.get('sellingValue') or 1} {item['sellingUnit']}{quantity_suffix}{notes_suffix}"
+
+
 async def generate_meal_plan_from_items(items: List[dict], store_name: str) -> dict:
     """Generates a meal plan using Gemini Flash based on a list of flyer items."""
     print(f"[*] Starting meal plan generation using {len(items)} items from {store_name}.")
@@ -348,12 +559,7 @@ async def generate_meal_plan_from_items(items: List[dict], store_name: str) -> d
         return {"error": "No flyer items provided to generate meal plan."}
 
     # Format items for the prompt
-    item_list_str = "\n".join([
-        f"- {item['name']}: ${item['price']:.2f} / {item.get('sellingValue') or 1} {item['sellingUnit']}" +
-        (f" ({item.get('measuredQuantityValue')} {item.get('measuredQuantityUnit')})" if item.get('measuredQuantityValue') and item.get('measuredQuantityUnit') else "") +
-        (f" (Notes: {item.get('notes')})" if item.get('notes') else "")
-        for item in items
-    ])
+    item_list_str = "\n".join(_format_meal_plan_item(item) for item in items)
 
     prompt = f"""
 Here is the food items list from a {store_name} flyer in CAD:
@@ -372,18 +578,9 @@ After the 5-day plan, add a clear header "Shopping List:" and then list all the
 """
 
     try:
-        # Use gemini-1.5-flash-latest (or the specific version you intend)
-        model = genai.GenerativeModel(
-            model_name="gemini-1.5-flash-latest",
-            generation_config=flash_generation_config,
-            safety_settings=safety_settings,
-            # No function calling needed here, we'll parse the text response
-        )
-
         print("[*] Sending request to Gemini API for meal plan...")
-        # Use generate_content_async for async compatibility if needed, or run sync in thread
-        # For simplicity here, using the sync version (FastAPI runs it in a threadpool)
-        response = model.generate_content(prompt)
+        # Async call so the event loop keeps serving other requests during the Gemini round trip
+        response = await _meal_plan_model.generate_content_async(prompt)
         print("[*] Received response from Gemini API.")
 
         if response.text: